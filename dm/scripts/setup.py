@@ -17,12 +17,13 @@
 import importlib
 import logging
 import os
+import re
 import sys
 import shutil
 import time
 from pathlib import Path
 from subprocess import DEVNULL
-from functools import reduce, partialmethod
+from functools import lru_cache, partialmethod
 from concurrent.futures import ThreadPoolExecutor
 
 import googleapiclient.discovery
@@ -30,14 +31,24 @@ import requests
 import yaml
 
 
-# get util.py from metadata
-UTIL_FILE = Path('/tmp/util.py')
+# get all instance attributes from metadata in a single request
+META_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/attributes/'
+_META_ATTRS = {}
 try:
-    resp = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/attributes/util-script',
+    resp = requests.get(META_URL, params={'recursive': 'true', 'alt': 'json'},
                         headers={'Metadata-Flavor': 'Google'})
     resp.raise_for_status()
-    UTIL_FILE.write_text(resp.text)
-except requests.exceptions.RequestException:
+    _META_ATTRS = resp.json()
+except (requests.exceptions.RequestException, ValueError):
+    print("instance attributes not found in metadata")
+
+# get util.py from metadata, unless a previous run already wrote it
+UTIL_FILE = Path('/tmp/util.py')
+if 'util-script' in _META_ATTRS:
+    util_text = _META_ATTRS['util-script']
+    if not UTIL_FILE.exists() or UTIL_FILE.read_text() != util_text:
+        UTIL_FILE.write_text(util_text)
+else:
     print("util.py script not found in metadata")
     if not UTIL_FILE.exists():
         print(f"{UTIL_FILE} also does not exist, aborting")
@@ -57,7 +68,8 @@ log = logging.getLogger(Path(__file__).name)
 sys.excepthook = util.handle_exception
 
 # get setup config from metadata
-config_yaml = yaml.safe_load(util.get_metadata('attributes/config'))
+config_yaml = yaml.safe_load(_META_ATTRS.get('config') or
+                             util.get_metadata('attributes/config'))
 cfg = util.Config.new_config(config_yaml)
 
 # load all directories as Paths into a dict-like namespace
@@ -75,6 +87,10 @@ SUSPEND_TIMEOUT = 300
 
 CONTROL_MACHINE = cfg.cluster_name + '-controller'
 
+# partition of this instance, and all partitions as (pid, instance_def)
+PID = util.get_pid(cfg.hostname) if cfg.instance_type == 'compute' else None
+INSTANCE_DEFS = list((cfg.instance_defs or {}).items())
+
 
 
 def start_motd():
@@ -103,61 +119,123 @@ Log back in to ensure your home directory is correct.
 # END start_motd()
 
 
+@lru_cache(maxsize=1)
+def compute_client():
+    """ Build the compute API client once and reuse it. The discovery
+    document bundled with google-api-python-client is used, so no fetch is
+    needed during boot.
+    """
+    return googleapiclient.discovery.build('compute', 'v1',
+                                           cache_discovery=False,
+                                           static_discovery=True)
+
+
+def execute_batch(compute, reqs):
+    """ Execute dict of request_id: request in a batch request, retrying
+    rate limited requests. Returns dict of request_id: response
+    """
+    responses = {}
+    retry_list = []
+    errors = []
+
+    def batch_cb(request_id, response, exception):
+        if exception is not None:
+            if "Rate Limit Exceeded" in str(exception):
+                retry_list.append(request_id)
+            else:
+                log.error(f"batch exception for {request_id}: {exception}")
+                errors.append(exception)
+        else:
+            responses[request_id] = response
+
+    sleep = 1
+    max_sleep = 60
+    while reqs:
+        batch = compute.new_batch_http_request(callback=batch_cb)
+        for request_id, request in reqs.items():
+            batch.add(request, request_id=request_id)
+        util.ensure_execute(batch)
+        if errors:
+            raise errors[0]
+
+        reqs = {rid: reqs[rid] for rid in retry_list}
+        retry_list.clear()
+        if reqs:
+            sleep = min(sleep*2, max_sleep)
+            log.error(f"rate limited, retrying {len(reqs)} requests "
+                      f"after {sleep}s")
+            time.sleep(sleep)
+    return responses
+# END execute_batch()
+
+
 def expand_instance_templates():
     """ Expand instance template into instance_defs """
 
-    compute = googleapiclient.discovery.build('compute', 'v1',
-                                              cache_discovery=False)
-    for pid, instance_def in cfg.instance_defs.items():
+    compute = compute_client()
+
+    # fetch all needed templates in one batch request
+    template_reqs = {
+        pid: compute.instanceTemplates().get(
+            project=cfg.project,
+            instanceTemplate=instance_def.instance_template)
+        for pid, instance_def in INSTANCE_DEFS
         if (instance_def.instance_template and
-                (not instance_def.machine_type or not instance_def.gpu_count)):
-            template_resp = util.ensure_execute(
-                compute.instanceTemplates().get(
-                    project=cfg.project,
-                    instanceTemplate=instance_def.instance_template))
-            if template_resp:
-                template_props = template_resp['properties']
-                if not instance_def.machine_type:
-                    instance_def.machine_type = template_props['machineType']
-                if (not instance_def.gpu_count and
-                        'guestAccelerators' in template_props):
-                    accel_props = template_props['guestAccelerators'][0]
-                    instance_def.gpu_count = accel_props['acceleratorCount']
-                    instance_def.gpu_type = accel_props['acceleratorType']
+            (not instance_def.machine_type or not instance_def.gpu_count))
+    }
+    templates = execute_batch(compute, template_reqs)
+
+    for pid, template_resp in templates.items():
+        instance_def = cfg.instance_defs[pid]
+        template_props = template_resp['properties']
+        if not instance_def.machine_type:
+            instance_def.machine_type = template_props['machineType']
+        if (not instance_def.gpu_count and
+                'guestAccelerators' in template_props):
+            accel_props = template_props['guestAccelerators'][0]
+            instance_def.gpu_count = accel_props['acceleratorCount']
+            instance_def.gpu_type = accel_props['acceleratorType']
 # END expand_instance_templates()
 
 
 def expand_machine_type():
     """ get machine type specs from api """
     machines = {}
-    compute = googleapiclient.discovery.build('compute', 'v1',
-                                              cache_discovery=False)
-    for pid, part in cfg.instance_defs.items():
-        machine = {'cpus': 1, 'memory': 1}
-        machines[pid] = machine
+    compute = compute_client()
+
+    # fetch machine types for all partitions in one batch request
+    type_reqs = {}
+    for pid, part in INSTANCE_DEFS:
+        machines[pid] = {'cpus': 1, 'memory': 1}
 
         if not part.machine_type:
             log.error("No machine type to get configuration from")
             continue
 
-        type_resp = None
         if part.regional_capacity:
             filter = f"(zone={part.region}-*) AND (name={part.machine_type})"
-            list_resp = util.ensure_execute(
-                compute.machineTypes().aggregatedList(
-                    project=cfg.project, filter=filter))
+            type_reqs[pid] = compute.machineTypes().aggregatedList(
+                project=cfg.project, filter=filter)
+        else:
+            type_reqs[pid] = compute.machineTypes().get(
+                project=cfg.project, zone=part.zone,
+                machineType=part.machine_type)
+    responses = execute_batch(compute, type_reqs)
+
+    for pid, resp in responses.items():
+        part = cfg.instance_defs[pid]
+        machine = machines[pid]
 
-            if 'items' in list_resp:
-                zone_types = list_resp['items']
+        type_resp = None
+        if part.regional_capacity:
+            if 'items' in resp:
+                zone_types = resp['items']
                 for k, v in zone_types.items():
                     if part.region in k and 'machineTypes' in v:
                         type_resp = v['machineTypes'][0]
                         break
         else:
-            type_resp = util.ensure_execute(
-                compute.machineTypes().get(
-                    project=cfg.project, zone=part.zone,
-                    machineType=part.machine_type))
+            type_resp = resp
 
         if type_resp:
             cpus = type_resp['guestCpus']
@@ -188,25 +266,40 @@ def install_meta_files():
     ]
 
     def install_metafile(filename, metaname):
-        text = util.get_metadata('attributes/' + metaname)
+        # only fetch attributes individually if the batched fetch failed
+        if _META_ATTRS:
+            text = _META_ATTRS.get(metaname)
+        else:
+            text = util.get_metadata('attributes/' + metaname)
         if not text:
             return
         path = dirs.scripts/filename
         path.write_text(text)
         path.chmod(0o755)
 
-    with ThreadPoolExecutor() as exe:
-        exe.map(lambda x: install_metafile(*x), meta_entries)
+    with ThreadPoolExecutor(max_workers=len(meta_entries)) as exe:
+        list(exe.map(lambda x: install_metafile(*x), meta_entries))
 
 # END install_meta_files()
 
 
-def prepare_network_mounts(hostname, instance_type):
-    """ Prepare separate lists of cluster-internal and external mounts for the
-    given host instance, returning (external_mounts, internal_mounts)
+@lru_cache()
+def resolve_path(path):
+    """ Path.resolve, memoized since the same mounts are resolved repeatedly """
+    return Path(path).resolve()
+
+
+def listtodict(mountlist):
+    """ convert network_storage list of mounts to dict of mounts,
+    local_mount as key
     """
-    log.info("Set up network storage")
+    return {resolve_path(d['local_mount']): d for d in mountlist}
 
+
+def base_network_mounts():
+    """ Return dict of mounts common to all instances: the default controller
+    mounts overlaid with cfg.network_storage. Keyed by local_mount.
+    """
     default_mounts = (
         dirs.home,
         dirs.apps,
@@ -227,37 +320,36 @@ def prepare_network_mounts(hostname, instance_type):
         for path in default_mounts
     }
 
-    # convert network_storage list of mounts to dict of mounts,
-    #   local_mount as key
-    def listtodict(mountlist):
-        return {Path(d['local_mount']).resolve(): d for d in mountlist}
-
     # On non-controller instances, entries in network_storage could overwrite
     # default exports from the controller. Be careful, of course
     mounts.update(listtodict(cfg.network_storage))
+    return mounts
+# END base_network_mounts()
+
+
+def prepare_network_mounts():
+    """ Prepare separate lists of cluster-internal and external mounts for
+    this instance, returning (external_mounts, internal_mounts)
+    """
+    log.info("Set up network storage")
 
-    if instance_type == 'compute':
-        pid = util.get_pid(hostname)
-        mounts.update(listtodict(cfg.instance_defs[pid].network_storage))
+    mounts = base_network_mounts()
+
+    if cfg.instance_type == 'compute':
+        mounts.update(listtodict(cfg.instance_defs[PID].network_storage))
     else:
         # login_network_storage is mounted on controller and login instances
         mounts.update(listtodict(cfg.login_network_storage))
 
     # filter mounts into two dicts, cluster-internal and external mounts, and
     # return both. (external_mounts, internal_mounts)
-    def internal_mount(mount):
-        return mount[1].server_ip == CONTROL_MACHINE
-
-    def partition(pred, coll):
-        """ filter into 2 lists based on pred returning True or False 
-            returns ([False], [True])
-        """
-        return reduce(
-            lambda acc, el: acc[pred(el)].append(el) or acc,
-            coll, ([], [])
-        )
-
-    return tuple(map(dict, partition(internal_mount, mounts.items())))
+    ext_mounts, int_mounts = {}, {}
+    for local_mount, mount in mounts.items():
+        if mount.server_ip == CONTROL_MACHINE:
+            int_mounts[local_mount] = mount
+        else:
+            ext_mounts[local_mount] = mount
+    return ext_mounts, int_mounts
 # END prepare_network_mounts
 
 
@@ -265,8 +357,7 @@ def setup_network_storage():
     """ prepare network fs mounts and add them to fstab """
 
     global mounts
-    ext_mounts, int_mounts = prepare_network_mounts(cfg.hostname,
-                                                    cfg.instance_type)
+    ext_mounts, int_mounts = prepare_network_mounts()
     mounts = ext_mounts
     if cfg.instance_type != 'controller':
         mounts.update(int_mounts)
@@ -286,8 +377,6 @@ def setup_network_storage():
             fs_type, server_ip+':' if fs_type != 'gcsfuse' else "",
             remote_mount, local_mount))
 
-        local_mount.mkdirp()
-
         mount_options = (mount.mount_options.split(',') if mount.mount_options
                          else [])
         if not mount_options or '_netdev' not in mount_options:
@@ -301,35 +390,31 @@ def setup_network_storage():
                 .format(remote_mount, local_mount, fs_type,
                         ','.join(mount_options)))
         else:
-            remote_mount = Path(remote_mount).resolve()
+            remote_mount = resolve_path(remote_mount)
             fstab_entries.append(
                 "{0}:{1}    {2}     {3}      {4}  0 0"
                 .format(server_ip, remote_mount, local_mount,
                         fs_type, ','.join(mount_options)))
 
-    for mount in mounts:
-        Path(mount).mkdirp()
+    with ThreadPoolExecutor(max_workers=16) as exe:
+        list(exe.map(lambda p: Path(p).mkdirp(), mounts))
     with open('/etc/fstab', 'a') as f:
-        f.write('\n')
-        for entry in fstab_entries:
-            f.write(entry)
-            f.write('\n')
+        f.write('\n' + '\n'.join(fstab_entries) + '\n')
 # END setup_network_storage()
 
 
 def mount_fstab():
-    """ Wait on each mount, then make sure all fstab is mounted """
+    """ Mount all of fstab, retrying until every network mount is up """
     global mounts
 
-    def mount_path(path):
-        while not os.path.ismount(path):
-            log.info(f"Waiting for {path} to be mounted")
-            util.run(f"mount {path}", wait=5)
-
-    with ThreadPoolExecutor() as exe:
-        exe.map(mount_path, mounts.keys())
-
-    util.run("mount -a", wait=1)
+    # -F forks a mount per filesystem so hard NFS mounts retry concurrently
+    while True:
+        util.run("mount -a -F")
+        pending = [path for path in mounts if not os.path.ismount(path)]
+        if not pending:
+            break
+        log.info(f"Waiting for {', '.join(map(str, pending))} to be mounted")
+        time.sleep(5)
 # END mount_external
 
 
@@ -337,20 +422,34 @@ def setup_nfs_exports():
     """ nfs export all needed directories """
     # The controller only needs to set up exports for cluster-internal mounts
     # switch the key to remote mount path since that is what needs exporting
-    _, con_mounts = prepare_network_mounts(cfg.hostname, cfg.instance_type)
-    con_mounts = {m.remote_mount: m for m in con_mounts.values()}
-    for pid, _ in cfg.instance_defs.items():
-        # get internal mounts for each partition by calling
-        # prepare_network_mounts as from a node in each partition
-        _, part_mounts = prepare_network_mounts(f'{pid}-n', 'compute')
-        part_mounts = {m.remote_mount: m for m in part_mounts.values()}
-        con_mounts.update(part_mounts)
+    # the default and global mounts are the same for the controller and every
+    # partition, so compute them once and overlay each one's own storage
+    base_mounts = base_network_mounts()
+    con_mounts = {}
+    for network_storage in (cfg.login_network_storage,
+                            *(part.network_storage
+                              for _, part in INSTANCE_DEFS)):
+        host_mounts = base_mounts.copy()
+        host_mounts.update(listtodict(network_storage))
+        con_mounts.update({
+            m.remote_mount: m for m in host_mounts.values()
+            if m.server_ip == CONTROL_MACHINE
+        })
+
+    # remove any existing /etc/exports entries for the exported paths
+    etc_exports = Path('/etc/exports')
+    if con_mounts and etc_exports.exists():
+        pattern = re.compile('|'.join(re.escape(str(p)) for p in con_mounts))
+        lines = [line for line in etc_exports.read_text().splitlines()
+                 if not pattern.search(line)]
+        etc_exports.write_text('\n'.join(lines) + '\n')
+
+    with ThreadPoolExecutor(max_workers=16) as exe:
+        list(exe.map(lambda p: Path(p).mkdirp(), con_mounts))
 
     # export path if corresponding selector boolean is True
     exports = []
     for path in con_mounts:
-        Path(path).mkdirp()
-        util.run(rf"sed -i '\#{path}#d' /etc/exports")
         exports.append(f"{path}  *(rw,no_subtree_check,no_root_squash)")
 
     exportsd = Path('/etc/exports.d')
@@ -362,10 +461,18 @@ def setup_nfs_exports():
 # END setup_nfs_exports()
 
 
-def setup_secondary_disks():
-    """ Format and mount secondary disk """
-    util.run(
+def format_secondary_disks():
+    """ Start formatting secondary disk in the background, returning the
+    mkfs process
+    """
+    return util.spawn(
         "sudo mkfs.ext4 -m 0 -F -E lazy_itable_init=0,lazy_journal_init=0,discard /dev/sdb")
+# END format_secondary_disks()
+
+
+def setup_secondary_disks(mkfs):
+    """ Wait for secondary disk format to finish, then add it to fstab """
+    mkfs.wait()
     Path(dirs.secdisk).mkdirp()
     with open('/etc/fstab', 'a') as f:
         f.write(
@@ -379,9 +486,11 @@ def setup_controller():
     """ Run controller setup """
     expand_instance_templates()
 
-    if cfg.controller_secondary_disk:
-        setup_secondary_disks()
+    # format the secondary disk while network storage is being prepared
+    mkfs = format_secondary_disks() if cfg.controller_secondary_disk else None
     setup_network_storage()
+    if mkfs:
+        setup_secondary_disks(mkfs)
     mount_fstab()
 
     try:
@@ -419,13 +528,22 @@ def setup_compute():
     setup_network_storage()
     mount_fstab()
 
-    pid = util.get_pid(cfg.hostname)
-    if cfg.instance_defs[pid].gpu_count:
-        retries = n = 50
-        while util.run("nvidia-smi").returncode != 0 and n > 0:
-            n -= 1
-            log.info(f"Nvidia driver not yet loaded, try {retries-n}")
-            time.sleep(5)
+    if cfg.instance_defs[PID].gpu_count:
+        # wait for the driver's device node rather than polling nvidia-smi.
+        # Without udev rules nvidia-modprobe creates the device files.
+        util.run("modprobe nvidia")
+        if shutil.which('nvidia-modprobe'):
+            util.run("nvidia-modprobe -c0 -u")
+        delay, timeout = 0.1, 250
+        start = time.monotonic()
+        while (not os.path.exists('/dev/nvidia0') and
+               time.monotonic() - start < timeout):
+            log.info("Nvidia driver not yet loaded, waited "
+                     f"{time.monotonic() - start:.1f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+        if util.run("nvidia-smi").returncode != 0:
+            log.error("Nvidia driver failed to load")
 
     try:
         util.run(str(dirs.scripts/'custom-compute-install'))